@@ -1,19 +1,40 @@
 import argparse
-import csv
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from datetime import date
-import json
 import logging
 import re
 import time
 
-import boto3
 from botocore.exceptions import ClientError
 
 import s3_user_utils
 
 logger = logging.getLogger(__name__)
-iam = boto3.resource('iam')
+
+# One or more letters, numbers, underscores, and dashes
+_USER_NAME_RE = re.compile(r'\A[A-Za-z0-9_-]+\Z')
+
+# Pre-serialized policy documents with a single statement.
+# For the s3 listbucket we add a condition to restrict to listing the user's folder.
+_LIST_POLICY_TMPL = (
+    '{{"Version": "2012-10-17", "Statement": [{{'
+    '"Effect": "Allow", "Action": "s3:ListBucket", "Resource": "arn:aws:s3:::{bucket}", '
+    '"Condition": {{"StringEquals": {{"s3:prefix": ["", "{user}/"], "s3:delimiter": ["/"]}}}}'
+    '}}]}}'
+)
+# For the s3 getobject we add the user folder to the resource arn.
+_GET_POLICY_TMPL = (
+    '{{"Version": "2012-10-17", "Statement": [{{'
+    '"Effect": "Allow", "Action": "{action}", "Resource": "arn:aws:s3:::{bucket}/{user}/*"'
+    '}}]}}'
+)
+
+# Description and action for each of the user policies, keyed by policy kind
+USER_POLICIES = {
+    'list': ('Grant permission to list bucket for user folder', 's3:ListBucket'),
+    'get': ('Grant permission to get objects from users folder', 's3:GetObject'),
+}
 
 
 def create_s3_user():
@@ -35,8 +56,7 @@ def create_s3_user():
     # Set up logging
     run_date = f'{date.today().strftime("%Y%m%d")}'
     log_filename = f'create_s3_user_{run_date}.log'
-    logging.basicConfig(filename=log_filename, level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
-    logger = logging.getLogger()
+    logging.basicConfig(filename=log_filename, level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', force=True)
 
     # Define input arguments
     parser = argparse.ArgumentParser()
@@ -49,7 +69,7 @@ def create_s3_user():
     args = parser.parse_args()
     bucket_name = args.bucket_name
     user_name = args.user_name
-    logger.info(f'Creating iam-user {user_name} for bucket {bucket_name}')
+    logger.info('Creating iam-user %s for bucket %s', user_name, bucket_name)
 
     try:
         # Validate the bucket name and user name
@@ -59,15 +79,14 @@ def create_s3_user():
             exit_program(f'Invalid user name: {user_name}. Only letters, numbers, underscores, and dashes are allowed.')
 
         # Exit if the user name is already in use for this account
-        for existing_user in s3_user_utils.list_users():
-            if user_name == existing_user.name:
-                exit_program(f'This user already exists in the account: {user_name}')
+        if user_exists(user_name):
+            exit_program(f'This user already exists in the account: {user_name}')
 
         # Create the new iam user
-        user = s3_user_utils.create_user(user_name)
+        s3_user_utils.create_user(user_name)
 
         # Create s3 list- and get-policies and attach to user
-        create_and_add_policies(user, bucket_name)
+        create_and_add_policies(user_name, bucket_name)
 
         # Generate user keys and write to local csv file
         key_pair = s3_user_utils.create_key(user_name)
@@ -82,37 +101,45 @@ def create_s3_user():
         print('Success!')
 
 
-def create_and_add_policies(user, bucket_name):
+def create_and_add_policies(user_name, bucket_name):
     """
     Create and add policies such that users can only view (s3-ListBucket) 
     and download items (s3-GetOBject) from their personal folder (the s3 prefix).
 
     For the purposes of this demo we will create new policies for the new user.
     In production we would have a single durable policy that reads the 'aws:username' variable.
+
+    Both policy names are checked before anything is created. The list and get policies
+    are independent, so they are then created and attached concurrently.
+
+    The user is passed by name rather than as an IAM User resource, so that reading the
+    name never triggers a lazy load (GetUser request) of the resource attributes.
     """
-    logger.info(f'Creating list and get policies for bucket {bucket_name}')
+    logger.info('Creating list and get policies for bucket %s', bucket_name)
 
-    # Create and add the list policy
-    policy_name = s3_user_utils.user_policy_name(user.user_name, 'list')
-    policy_description = 'Grant permission to list bucket for user folder'
-    action = 's3:ListBucket'
-    if policy_exists(policy_name):
-        exit_program(f'Cannot create policy because it already exists: {policy_name}')
-    list_policy = create_policy(
-        policy_name, policy_description,
-        action, bucket_name, user.name)
-    s3_user_utils.attach_policy(user.name, list_policy.arn)
-
-    # Create and add the get policy
-    policy_name = s3_user_utils.user_policy_name(user.user_name, 'get')   
-    policy_description = 'Grant permission to get objects from users folder'
-    action = 's3:GetObject'
-    if policy_exists(policy_name):
-        exit_program(f'Cannot create policy because it already exists: {policy_name}')       
-    get_policy = create_policy(
+    # Exit before creating either policy if one of the names is already in use
+    for kind in USER_POLICIES:
+        policy_name = s3_user_utils.user_policy_name(user_name, kind)
+        if s3_user_utils.policy_exists(policy_name):
+            exit_program(f'Cannot create policy because it already exists: {policy_name}')
+
+    with ThreadPoolExecutor(max_workers=len(USER_POLICIES)) as pool:
+        futures = [pool.submit(_create_and_attach, user_name, bucket_name, kind) for kind in USER_POLICIES]
+        # Re-raise any error from the worker threads
+        for future in futures:
+            future.result()
+
+
+def _create_and_attach(user_name, bucket_name, kind):
+    """
+    Create the 'list' or 'get' policy for the user and attach it to the user.
+    """
+    policy_name = s3_user_utils.user_policy_name(user_name, kind)
+    policy_description, action = USER_POLICIES[kind]
+    policy_arn = create_policy(
         policy_name, policy_description,
-        action, bucket_name, user.name)
-    s3_user_utils.attach_policy(user.name, get_policy.arn)
+        action, bucket_name, user_name)
+    s3_user_utils.attach_policy(user_name, policy_arn)
 
 
 def create_policy(name, description, actions, bucket_name, user_name):
@@ -127,6 +154,9 @@ def create_policy(name, description, actions, bucket_name, user_name):
 
     For GetObject the restriction is specified in the resource arn. 
 
+    The policy json is filled in from the _LIST_POLICY_TMPL and _GET_POLICY_TMPL templates.
+    Bucket and user names cannot contain characters that need escaping in json.
+
     :param name: The name of the policy to create.
     :param description: The description of the policy.
     :param actions: The actions allowed by the policy. For this demo we are looking for
@@ -134,70 +164,41 @@ def create_policy(name, description, actions, bucket_name, user_name):
     :param bucket_name: The bucket name will be used to create the Amazon Resource Name (ARN) 
                         of the resource that this policy applies to. 
     :param user_name: The iam user name that matches the user folder in s3.
-    :return: The newly created policy.
+    :return: The ARN of the newly created policy.
     """
 
-    # For the s3 getobject we add the user folder to the resource arn
-    if actions == 's3:GetObject':
-        resource_arn = f'arn:aws:s3:::{bucket_name}/{user_name}/*'
-    else:
-        resource_arn = f'arn:aws:s3:::{bucket_name}'
-
-    # Create the policy json
-    policy_doc = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": actions,
-                "Resource": resource_arn,
-            }
-        ]
-    }
-
-    # For the s3 listbucket we add a condition to restrict to listing the user's folder
+    # Fill in the pre-serialized policy json for the action
     if actions == 's3:ListBucket':
-        user_folder = f'{user_name}/'
-        condition = { 
-                        "Condition":{
-                            "StringEquals": {
-                                "s3:prefix": [
-                                    "",
-                                    user_folder
-                                ],
-                                "s3:delimiter": [
-                                    "/"
-                                ]
-                            }
-                        }
-                    }
-        # Update the statement dictionary with the condition
-        policy_doc['Statement'][0].update(condition)
-
-    logger.info(f'Policy doc: {policy_doc}')
+        policy_doc = _LIST_POLICY_TMPL.format(bucket=bucket_name, user=user_name)
+    else:
+        policy_doc = _GET_POLICY_TMPL.format(action=actions, bucket=bucket_name, user=user_name)
+
+    logger.info('Policy doc: %s', policy_doc)
     try:
-        policy = iam.create_policy(
+        # Use the thread-safe low-level client, since this runs in a worker thread
+        response = s3_user_utils.resource('iam').meta.client.create_policy(
             PolicyName=name, Description=description,
-            PolicyDocument=json.dumps(policy_doc))
-        logger.info(f'Created policy {policy.arn}')
+            PolicyDocument=policy_doc)
+        policy_arn = response['Policy']['Arn']
+        logger.info('Created policy %s', policy_arn)
     except ClientError:
-        logger.exception(f"Couldn't create policy {name}")
+        logger.exception("Couldn't create policy %s", name)
         raise
     else:
-        return policy
+        return policy_arn
 
 
-def policy_exists(policy_name):
+def user_exists(user_name):
     """
-    Returns true if the desired policy name is already in use in this account.
+    Returns true if the user name is already in use in this account.
     """
-    policy_exists = False
-    # Here we use 'Local' to search in locally managed policies, not AWS managed policies
-    for policy in s3_user_utils.list_policies('Local'):
-        if policy_name == policy.policy_name:
-            policy_exists = True
-            break
-    return policy_exists
+    try:
+        s3_user_utils.resource('iam').meta.client.get_user(UserName=user_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchEntity':
+            return False
+        raise
+    return True
 
 
 def is_valid_user_name(user_name):
@@ -205,8 +206,7 @@ def is_valid_user_name(user_name):
     Returns true if the user name is composed of one or more 
     letters, numbers, underscores, and dashes.
     """
-    is_valid = True if re.match("^[A-Za-z0-9_-]+$", user_name) else False
-    return is_valid
+    return _USER_NAME_RE.match(user_name) is not None
 
 
 def write_keys_to_csv(user_name, key_pair):
@@ -216,24 +216,24 @@ def write_keys_to_csv(user_name, key_pair):
     if key_pair is None:
         exit_program(f'No keys available to save to csv for user {user_name}')
 
-    key_info = [
-        ['Access key ID', 'Secret access key'],
-        [key_pair.id, key_pair.secret]
-    ]
+    # Header and key row with the csv module's default '\r\n' line endings.
+    # The key id and secret never contain characters that need csv quoting.
+    key_info = (
+        'Access key ID,Secret access key\r\n'
+        f'{key_pair.id},{key_pair.secret}\r\n'
+    )
     csv_filename = f'{user_name}_accessKeys.csv'
-    with open(csv_filename , 'w', newline='\n', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        for row in key_info:
-            writer.writerow(row)
-    csvfile.close
-    logger.info(f'Wrote keys to file {csv_filename}.')
+    # newline='' writes the '\r\n' line endings untranslated, as the csv docs recommend
+    with open(csv_filename, 'w', buffering=65536, newline='', encoding='utf-8') as csvfile:
+        csvfile.write(key_info)
+    logger.info('Wrote keys to file %s.', csv_filename)
 
 
 def exit_program(message):
     """
     Write error message to the log file and the console and exit.
     """
-    logger.error(f'Exiting. {message}')
+    logger.error('Exiting. %s', message)
     print(f'ERROR. Exiting. {message}')
     exit(0)
 
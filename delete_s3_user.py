@@ -1,15 +1,13 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
 from datetime import date
 import logging
-import boto3
 from botocore.exceptions import ClientError
 
 import s3_user_utils
 
 logger = logging.getLogger(__name__)
-iam = boto3.client('iam')
-s3 = boto3.resource('s3')
 
 
 def delete_s3_user():
@@ -28,8 +26,7 @@ def delete_s3_user():
     # Set up logging
     run_date = f'{date.today().strftime("%Y%m%d")}'
     log_filename = f'delete_s3_user_{run_date}.log'
-    logging.basicConfig(filename=log_filename, level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
-    logger = logging.getLogger()
+    logging.basicConfig(filename=log_filename, level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s', force=True)
 
     # Define input arguments
     parser = argparse.ArgumentParser()
@@ -42,35 +39,37 @@ def delete_s3_user():
     args = parser.parse_args()
     bucket_name = args.bucket_name
     user_name = args.user_name
-    logger.info(f'Deleting iam-user {user_name} for bucket {bucket_name}.')
+    logger.info('Deleting iam-user %s for bucket %s.', user_name, bucket_name)
 
     try:
         # Find and delete access keys for user
         all_keys_for_user = s3_user_utils.list_keys(user_name)
         if all_keys_for_user:
-            for key in all_keys_for_user:
-                logger.info(f'Deleting key {key.id} for user {user_name}.')
-                s3_user_utils.delete_key(user_name, key.id)
+            def delete_key(key_id):
+                logger.info('Deleting key %s for user %s.', key_id, user_name)
+                s3_user_utils.delete_key(user_name, key_id)
+
+            # A user has at most two keys, so delete them all concurrently
+            key_ids = [key.id for key in all_keys_for_user]
+            with ThreadPoolExecutor(max_workers=len(key_ids)) as pool:
+                list(pool.map(delete_key, key_ids))
         else:
-            logger.warning(f'No access keys found for user {user_name}.')
+            logger.warning('No access keys found for user %s.', user_name)
 
         # Detach and delete policies
-        listed_policies = s3_user_utils.list_policies('Local')
         user_policy_names = [ s3_user_utils.user_policy_name(user_name, 'list'), 
                               s3_user_utils.user_policy_name(user_name, 'get')]
         for user_policy_name in user_policy_names:
-            found_policy = False
-            for policy in listed_policies:
-                if policy.policy_name == user_policy_name:
-                    found_policy = True
-                    logger.info(f'Deleting policy {user_policy_name} for user {user_name}.')
-                    s3_user_utils.detach_policy(user_name,policy.arn)
-                    s3_user_utils.delete_policy(policy.arn)      
-            if not found_policy:
-                logger.warning(f'Cannot find policy to remove: {user_policy_name}.')
+            if s3_user_utils.policy_exists(user_policy_name):
+                policy_arn = s3_user_utils.policy_arn(user_policy_name)
+                logger.info('Deleting policy %s for user %s.', user_policy_name, user_name)
+                s3_user_utils.detach_policy(user_name, policy_arn)
+                s3_user_utils.delete_policy(policy_arn)
+            else:
+                logger.warning('Cannot find policy to remove: %s.', user_policy_name)
 
         # Delete iam user
-        logger.info(f'Deleting user {user_name}')
+        logger.info('Deleting user %s', user_name)
         s3_user_utils.delete_user(user_name)
 
         # Check that the bucket exists
@@ -78,20 +77,38 @@ def delete_s3_user():
             exit_program(f'Bucket does not exist: {bucket_name}')
 
         # Delete s3-objects for user
-        logger.info(f'Deleting objects for user {user_name} in bucket {bucket_name}.')
-        bucket = s3.Bucket(bucket_name)
+        logger.info('Deleting objects for user %s in bucket %s.', user_name, bucket_name)
         prefix = f'{user_name}/'
-        # Count objects to delete
-        user_object_count = 0
-        for key in bucket.objects.filter(Prefix=prefix):
-            user_object_count += 1
-        if user_object_count > 0:
-            logger.info(f'Number of ojects to delete: {user_object_count}')
-            # Delete objects with the user-name prefix
-            # https://stackoverflow.com/questions/11426560/amazon-s3-boto-how-to-delete-folder
-            bucket.objects.filter(Prefix=prefix).delete()
+        # List the objects with the user-name prefix and delete each page of up to
+        # 1000 keys with a single batch delete request. The deletes are sent
+        # concurrently while the paginator keeps listing.
+        s3_client = s3_user_utils.resource('s3').meta.client
+        paginator = s3_client.get_paginator('list_objects_v2')
+        futures = {}
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                objects = [{'Key': obj['Key']} for obj in page.get('Contents', [])]
+                if objects:
+                    future = pool.submit(s3_client.delete_objects, Bucket=bucket_name,
+                                         Delete={'Objects': objects, 'Quiet': True})
+                    futures[future] = len(objects)
+            # In quiet mode the response only lists the keys that could not be deleted
+            found_count = 0
+            failed_count = 0
+            for future in as_completed(futures):
+                errors = future.result().get('Errors', [])
+                for error in errors:
+                    logger.error("Couldn't delete object %s: %s", error['Key'], error['Message'])
+                found_count += futures[future]
+                failed_count += len(errors)
+        if found_count > 0:
+            logger.info('Number of objects found: %s, deleted: %s',
+                        found_count, found_count - failed_count)
+            if failed_count > 0:
+                exit_program(f'Could not delete {failed_count} of {found_count} objects '
+                             f'for user {user_name} in bucket {bucket_name}.')
         else:
-            logger.warning(f'No objects found for user {user_name} in bucket {bucket_name}.')
+            logger.warning('No objects found for user %s in bucket %s.', user_name, bucket_name)
         
     except Exception as e:
         error_message = "Error of type {0} occurred:{1!r}".format(type(e).__name__, str(e))
@@ -106,7 +123,7 @@ def exit_program(message):
     """
     Write error message to the log file and the console and exit.
     """
-    logger.error(f'Exiting. {message}')
+    logger.error('Exiting. %s', message)
     print(f'ERROR. Exiting. {message}')
     exit(0)
 
@@ -3,16 +3,59 @@ Utility methods for creating an IAM user with read-only
 access to s3 objects with a specific prefix. 
 """
 
+import functools
 import logging
+import os
 import time
 import json
 
-import boto3
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
-iam = boto3.resource('iam')
-s3 = boto3.resource('s3')
+
+# Local cache of the account id, keyed by the access key id it was looked up for
+_ACCOUNT_CACHE_FILE = os.path.join(
+    os.path.expanduser('~'), '.cache', 'python-aws-iam-user', 'account.json')
+
+
+# boto3 and botocore.config are imported and the session, config, resources and
+# clients are created on first use, so the scripts can parse their arguments
+# (or print --help) without importing the HTTP stack or loading the AWS service models.
+@functools.lru_cache(maxsize=None)
+def _config():
+    """
+    Returns the botocore config shared by every resource and client. The connection
+    pool is large enough for the concurrent requests made by the scripts (the default
+    is 10 connections), and the adaptive retry mode backs off when IAM or S3 throttle
+    the requests.
+    """
+    from botocore.config import Config
+    return Config(max_pool_connections=32, retries={'mode': 'adaptive', 'max_attempts': 10})
+
+
+@functools.lru_cache(maxsize=None)
+def session():
+    """
+    Returns the shared boto3 session.
+    """
+    import boto3
+    return boto3.session.Session()
+
+
+@functools.lru_cache(maxsize=None)
+def resource(service_name):
+    """
+    Returns the shared boto3 resource for the service, such as 'iam' or 's3'.
+    """
+    return session().resource(service_name, config=_config())
+
+
+@functools.lru_cache(maxsize=None)
+def client(service_name):
+    """
+    Returns the shared boto3 low-level client for the service, such as 'sts'.
+    """
+    return session().client(service_name, config=_config())
 
 
 def user_policy_name(user_name, s3_action):
@@ -23,12 +66,81 @@ def user_policy_name(user_name, s3_action):
     return f's3-{s3_action}-for-{user_name}'
 
 
+@functools.lru_cache(maxsize=None)
+def account_id():
+    """
+    Returns the id of the AWS account for the current credentials.
+
+    The id is cached in a local file together with the access key id of the
+    credentials, so the STS lookup is only done when the credentials change.
+    """
+    credentials = session().get_credentials()
+    access_key_id = credentials.access_key if credentials else None
+
+    cached = _read_account_cache()
+    if access_key_id and cached.get('access_key_id') == access_key_id and cached.get('account_id'):
+        return cached['account_id']
+
+    account = client('sts').get_caller_identity()['Account']
+    if access_key_id:
+        _write_account_cache(access_key_id, account)
+    return account
+
+
+def _read_account_cache():
+    """
+    Returns the cached access key id and account id, or an empty dict if
+    there is no readable cache file.
+    """
+    try:
+        with open(_ACCOUNT_CACHE_FILE, encoding='utf-8') as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    return cached if isinstance(cached, dict) else {}
+
+
+def _write_account_cache(access_key_id, account):
+    """
+    Writes the access key id and account id to the cache file.
+    A failed write is logged and otherwise ignored.
+    """
+    try:
+        os.makedirs(os.path.dirname(_ACCOUNT_CACHE_FILE), exist_ok=True)
+        with open(_ACCOUNT_CACHE_FILE, 'w', encoding='utf-8') as cache_file:
+            json.dump({'access_key_id': access_key_id, 'account_id': account}, cache_file)
+    except OSError:
+        logger.warning("Couldn't write account id cache %s.", _ACCOUNT_CACHE_FILE)
+
+
+def policy_arn(policy_name):
+    """
+    Returns the ARN of a locally managed policy with the format
+    'arn:aws:iam::[ACCOUNT_ID]:policy/[POLICY_NAME]'
+    """
+    return f'arn:aws:iam::{account_id()}:policy/{policy_name}'
+
+
+def policy_exists(policy_name):
+    """
+    Returns true if the policy name is already in use for a locally
+    managed policy in this account.
+    """
+    try:
+        resource('iam').meta.client.get_policy(PolicyArn=policy_arn(policy_name))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchEntity':
+            return False
+        raise
+    return True
+
+
 def bucket_exists(bucket_name):
     """
     Returns true if the bucket exists.
     """
     try:
-        s3.meta.client.head_bucket(Bucket=bucket_name)
+        resource('s3').meta.client.head_bucket(Bucket=bucket_name)
         bucket_exists = True
     except ClientError:
         # The bucket does not exist or you have no access.
@@ -48,7 +160,7 @@ def create_user(user_name):
     :return: The newly created user.
     """
     try:
-        user = iam.create_user(UserName=user_name)
+        user = resource('iam').create_user(UserName=user_name)
         logger.info("Created user %s.", user.name)
     except ClientError:
         logger.exception("Couldn't create user %s.", user_name)
@@ -65,7 +177,7 @@ def delete_user(user_name):
     :param user_name: The name of the user.
     """
     try:
-        iam.User(user_name).delete()
+        resource('iam').User(user_name).delete()
         logger.info("Deleted user %s.", user_name)
     except ClientError:
         logger.exception("Couldn't delete user %s.", user_name)
@@ -79,7 +191,7 @@ def list_users():
     :return: The list of users.
     """
     try:
-        users = list(iam.users.all())
+        users = list(resource('iam').users.all())
         logger.info("Got %s users.", len(users))
     except ClientError:
         logger.exception("Couldn't get users.")
@@ -97,7 +209,8 @@ def list_policies(scope):
     :return: The list of policies.
     """
     try:
-        policies = list(iam.policies.filter(Scope=scope))
+        # Request the IAM maximum of 1000 policies per page (the default is 100)
+        policies = list(resource('iam').policies.filter(Scope=scope).page_size(1000))
         logger.info("Got %s policies in scope '%s'.", len(policies), scope)
     except ClientError:
         logger.exception("Couldn't get policies for scope '%s'.", scope)
@@ -113,7 +226,7 @@ def delete_policy(policy_arn):
     :param policy_arn: The ARN of the policy to delete.
     """
     try:
-        iam.Policy(policy_arn).delete()
+        resource('iam').Policy(policy_arn).delete()
         logger.info("Deleted policy %s.", policy_arn)
     except ClientError:
         logger.exception("Couldn't delete policy %s.", policy_arn)
@@ -122,13 +235,14 @@ def delete_policy(policy_arn):
 
 def attach_policy(user_name, policy_arn):
     """
-    Attaches a policy to a user.
+    Attaches a policy to a user. This uses the low-level client, which,
+    unlike the resource, is safe to share between threads.
 
     :param user_name: The name of the user.
     :param policy_arn: The Amazon Resource Name (ARN) of the policy.
     """
     try:
-        iam.User(user_name).attach_policy(PolicyArn=policy_arn)
+        resource('iam').meta.client.attach_user_policy(UserName=user_name, PolicyArn=policy_arn)
         logger.info("Attached policy %s to user %s.", policy_arn, user_name)
     except ClientError:
         logger.exception("Couldn't attach policy %s to user %s.", policy_arn, user_name)
@@ -143,7 +257,7 @@ def detach_policy(user_name, policy_arn):
     :param policy_arn: The Amazon Resource Name (ARN) of the policy.
     """
     try:
-        iam.User(user_name).detach_policy(PolicyArn=policy_arn)
+        resource('iam').User(user_name).detach_policy(PolicyArn=policy_arn)
         logger.info("Detached policy %s from user %s.", policy_arn, user_name)
     except ClientError:
         logger.exception(
@@ -161,7 +275,7 @@ def create_key(user_name):
     :return: The created access key.
     """
     try:
-        key_pair = iam.User(user_name).create_access_key_pair()
+        key_pair = resource('iam').User(user_name).create_access_key_pair()
         logger.info(
             "Created access key pair for %s. Key ID is %s.",
             key_pair.user_name, key_pair.id)
@@ -174,16 +288,16 @@ def create_key(user_name):
 
 def delete_key(user_name, key_id):
     """
-    Deletes a user's access key.
+    Deletes a user's access key. This uses the low-level client, which,
+    unlike the resource, is safe to share between threads.
 
     :param user_name: The user that owns the key.
     :param key_id: The ID of the key to delete.
     """
     try:
-        key = iam.AccessKey(user_name, key_id)
-        key.delete()
+        resource('iam').meta.client.delete_access_key(UserName=user_name, AccessKeyId=key_id)
         logger.info(
-            "Deleted access key %s for %s.", key.id, key.user_name)
+            "Deleted access key %s for %s.", key_id, user_name)
     except ClientError:
         logger.exception("Couldn't delete key %s for %s", key_id, user_name)
         raise
@@ -191,13 +305,14 @@ def delete_key(user_name, key_id):
 
 def list_keys(user_name):
     """
-    Lists the keys owned by the specified user.
+    Lists the keys owned by the specified user. This is a single
+    ListAccessKeys request for the user, since a user has at most two keys.
 
     :param user_name: The name of the user.
     :return: The list of keys owned by the user.
     """
     try:
-        keys = list(iam.User(user_name).access_keys.all())
+        keys = list(resource('iam').User(user_name).access_keys.all())
         logger.info("Got %s access keys for %s.", len(keys), user_name)
     except ClientError:
         logger.exception("Couldn't get access keys for %s.", user_name)